@@ -118,25 +118,33 @@ for layer in params_shape:
     for param in layer:
         layer_shape.append((Nsample,) + param)
     params_batch_shape.append(layer_shape)
+# offsets of each parameter in the flattened per-sample noise
+params_size = [int(np.prod(param)) for layer in params_shape for param in layer]
+params_offset = np.cumsum([0] + params_size)
 
 
 def add_noise_batch_to_params(params, sigma, rng):
     noisy_params_batch = []
 
+    # Draw noise and update masks for all parameters at once, then split them up
+    rng_noise, rng_update = jax.random.split(rng)
+    noise_flat = jax.random.normal(rng_noise, (Nsample, params_offset[-1])) * sigma
+    # a simple implementation of Gibbs sampling
+    update_flat = jax.random.bernoulli(rng_update, 0.2, (Nsample, params_offset[-1]))
+
     # Iterate over each layer's parameters (weights and biases) and their shapes
+    k = 0
     for i, (param_layer, shape_layer) in enumerate(zip(params, params_batch_shape)):
         noisy_layer = []
         for j, (param, shape) in enumerate(zip(param_layer, shape_layer)):
-            # Generate Gaussian noise based on the cached shape
-            rng, rng_noise = jax.random.split(rng)
-            noise = jax.random.normal(rng_noise, shape) * sigma
+            start, end = params_offset[k], params_offset[k + 1]
+            noise = noise_flat[:, start:end].reshape(shape)
             if i == 0 and j == 0:
                 noise = noise * 0.1  # NOTE: first layer is too large, limit the noise
-            rng, rng_update = jax.random.split(rng)
-            # a simple implementation of Gibbs sampling
-            update_weight = jax.random.bernoulli(rng_update, 0.2, shape)
+            update_weight = update_flat[:, start:end].reshape(shape)
             noisy_param = param + noise * update_weight
             noisy_layer.append(noisy_param)
+            k += 1
         noisy_params_batch.append(noisy_layer)
 
     return noisy_params_batch
@@ -5,12 +5,14 @@ from jax import numpy as jnp
 from jax import config
 from dataclasses import dataclass
 import tyro
-from tqdm import tqdm
 from matplotlib import pyplot as plt
 from time import time
 
 import mbd
 
+# NOTE: benchmark curves are computed in float64
+config.update("jax_enable_x64", True)
+
 dim = 800
 fn_name = "Rastrigin"  # Ackley Rastrigin
 a, b, c = 20, 0.2, 2 * jnp.pi
@@ -62,8 +64,8 @@ eval_fn = {
 
 
 @jax.jit
-def reverse_once(carry, unused):
-    t, rng, mu_0t = carry
+def reverse_once(carry, t):
+    rng, mu_0t = carry
 
     # sample from q_i
     rng, Y0s_rng = jax.random.split(rng)
@@ -77,30 +79,25 @@ def reverse_once(carry, unused):
     weights = jax.nn.softmax(logp0)
     mu_0tm1 = jnp.einsum("n,ni->i", weights, Y0s)  # NOTE: update only with reward
 
-    return (t - 1, rng, mu_0tm1), Js.max()
+    return (rng, mu_0tm1), Js.max()
 
 
-def run_exp(seed=0):
+# NOTE: experiments are independent, so all seeds are vmapped into one call
+@jax.jit
+@jax.vmap
+def run_exp(seed):
     rng = jax.random.PRNGKey(seed)
     mu_0t = jnp.zeros([Nsample, dim]) + 1.0 * jax.random.normal(rng, (Nsample, dim))
-    _, _ = reverse_once((0, rng, mu_0t), None)  # to compile
-    xs, ys = [], []
-    with tqdm(range(Ndiffuse - 1, 0, -1), desc="Diffusing") as pbar:
-        for t in pbar:
-            carry_once = (t, rng, mu_0t)
-            (t, rng, mu_0t), J = reverse_once(carry_once, None)
-            xs.append((Ndiffuse - 1 - t) * Nsample)
-            ys.append(J)
-            pbar.set_postfix({"rew": f"{J:.2e}"})
-    return jnp.array(xs), jnp.array(ys)
+    # the initial guess has one mean per sample, so take the first step outside scan
+    (rng, mu_0t), J = reverse_once((rng, mu_0t), Ndiffuse - 1)
+    _, Js = jax.lax.scan(reverse_once, (rng, mu_0t), jnp.arange(Ndiffuse - 2, 0, -1))
+    return jnp.concatenate([J[None], Js])
 
 
 if __name__ == "__main__":
-    yss = []
-    for seed in range(Nexp):
-        xs, ys = run_exp(seed)
-        yss.append(ys)
-    ys = jnp.stack(yss).mean(axis=0)
+    xs = jnp.arange(1, Ndiffuse) * Nsample
+    yss = run_exp(jnp.arange(Nexp))
+    ys = yss.mean(axis=0)
     jnp.save(
         f"{mbd.__path__[0]}/../results/bbo/{fn_name}-{dim}d_MBD.npy",
         jnp.array([xs, ys]),
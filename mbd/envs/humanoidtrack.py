@@ -64,14 +64,13 @@ class HumanoidTrack(PipelineEnv):
         """Runs one timestep of the environment's dynamics."""
         pipeline_state = self.pipeline_step(state.pipeline_state, action)
         # set reference state for visualization
-        for i, idx in enumerate(self.ref_body_idx):
-            pipeline_state = pipeline_state.replace(
-                x=pipeline_state.x.replace(
-                    pos=pipeline_state.x.pos.at[idx].set(
-                        self.xref[i, jnp.int32(state.done)]
-                    ),
-                )
+        pipeline_state = pipeline_state.replace(
+            x=pipeline_state.x.replace(
+                pos=pipeline_state.x.pos.at[self.ref_body_idx].set(
+                    self.xref[:, jnp.int32(state.done)]
+                ),
             )
+        )
         # quad_impact_cost is not computed here
 
         obs = self._get_obs(pipeline_state)
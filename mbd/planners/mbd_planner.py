@@ -1,8 +1,8 @@
 import functools
 import os
+import numpy as np
 import jax
 from jax import numpy as jnp
-from jax import config
 from dataclasses import dataclass
 import tyro
 from tqdm import tqdm
@@ -10,8 +10,6 @@ from matplotlib import pyplot as plt
 
 import mbd
 
-# NOTE: enable this if you want higher precision
-config.update("jax_enable_x64", True)
 
 ## load config
 @dataclass
@@ -20,6 +18,8 @@ class Args:
     seed: int = 0
     disable_recommended_params: bool = False
     not_render: bool = False
+    enable_x64: bool = False  # float64, float32 is enough for sampling
+    pbar_interval: int = 10  # diffusion steps between progress bar updates
     # env
     env_name: str = (
         "ant"  # "humanoidstandup", "ant", "halfcheetah", "hopper", "walker2d", "car2d"
@@ -35,6 +35,14 @@ class Args:
 
 
 def run_diffusion(args: Args):
+    with mbd.utils.enable_x64(args.enable_x64):
+        return _run_diffusion(args)
+
+
+def _run_diffusion(args: Args):
+
+    if args.pbar_interval < 1:
+        raise ValueError(f"pbar_interval must be at least 1, got {args.pbar_interval}")
 
     rng = jax.random.PRNGKey(seed=args.seed)
 
@@ -72,8 +80,11 @@ def run_diffusion(args: Args):
     # env functions
     step_env_jit = jax.jit(env.step)
     reset_env_jit = jax.jit(env.reset)
-    # eval_us = jax.jit(functools.partial(mbd.utils.eval_us, step_env_jit))
+    eval_us = jax.jit(functools.partial(mbd.utils.eval_us, step_env_jit))
     rollout_us = jax.jit(functools.partial(mbd.utils.rollout_us, step_env_jit))
+    eval_us_batch = jax.jit(jax.vmap(eval_us, in_axes=(None, 0)))
+    rollout_us_batch = jax.jit(jax.vmap(rollout_us, in_axes=(None, 0)))
+    sample_sharding = mbd.utils.get_sample_sharding(args.Nsample)
 
     rng, rng_reset = jax.random.split(rng)  # NOTE: rng_reset should never be changed.
     state_init = reset_env_jit(rng_reset)
@@ -83,32 +94,69 @@ def run_diffusion(args: Args):
     betas = jnp.linspace(args.beta0, args.betaT, args.Ndiffuse)
     alphas = 1.0 - betas
     alphas_bar = jnp.cumprod(alphas)
-    sigmas = jnp.sqrt(1 - alphas_bar)
-    Sigmas_cond = (
-        (1 - alphas) * (1 - jnp.sqrt(jnp.roll(alphas_bar, 1))) / (1 - alphas_bar)
+    # alphas_bar of the previous step, 1.0 before the first step
+    alphas_bar_prev = jnp.concatenate(
+        [jnp.ones((1,), dtype=alphas_bar.dtype), alphas_bar[:-1]]
     )
+    sigmas = jnp.sqrt(1 - alphas_bar)
+    # NOTE: sigmas_cond[0] is 0 since alphas_bar_prev[0] is 1
+    Sigmas_cond = (1 - alphas) * (1 - jnp.sqrt(alphas_bar_prev)) / (1 - alphas_bar)
     sigmas_cond = jnp.sqrt(Sigmas_cond)
-    sigmas_cond = sigmas_cond.at[0].set(0.0)
+    # schedule terms used by reverse_once, precomputed once per run
+    sqrt_alphas = jnp.sqrt(alphas)
+    sqrt_alphas_bar = jnp.sqrt(alphas_bar)
+    sqrt_alphas_bar_prev = jnp.sqrt(alphas_bar_prev)
+    one_minus_alphas_bar = 1.0 - alphas_bar
+    inv_one_minus_alphas_bar = 1.0 / one_minus_alphas_bar
     print(f"init sigma = {sigmas[-1]:.2e}")
 
     YN = jnp.zeros([args.Hsample, Nu])
 
-    @jax.jit
-    def reverse_once(carry, unused):
-        i, rng, Ybar_i = carry
+    # schedule rows are scanned alongside the step so reverse_once is traced once
+    schedule = (
+        sigmas,
+        sqrt_alphas,
+        sqrt_alphas_bar,
+        sqrt_alphas_bar_prev,
+        one_minus_alphas_bar,
+        inv_one_minus_alphas_bar,
+    )
+
+    pbar = tqdm(total=args.Ndiffuse - 1, desc="Diffusing")
+
+    def update_pbar(i, rew):
+        pbar.set_postfix({"rew": f"{rew:.2e}"})
+        pbar.update(max(args.Ndiffuse - int(i) - pbar.n, 0))
+
+    def reverse_once(carry, step, *, Nsample, Hsample, Nu):
+        rng, Ybar_i = carry
+        i, (
+            sigma,
+            sqrt_alpha,
+            sqrt_alpha_bar,
+            sqrt_alpha_bar_prev,
+            one_minus_alpha_bar,
+            inv_one_minus_alpha_bar,
+        ) = step
         # Ybar_i is the current best estimate for controls / sqrt(alphas_bar[i - 1])
-        Yi = Ybar_i * jnp.sqrt(alphas_bar[i])
+        Yi = Ybar_i * sqrt_alpha_bar
 
         # sample from q_i
-        rng, Y0s_rng = jax.random.split(rng)
-        eps_u = jax.random.normal(Y0s_rng, (args.Nsample, args.Hsample, Nu))
+        # NOTE: derive the noise key from the step instead of splitting in the carry
+        Y0s_rng = jax.random.fold_in(rng, i)
+        eps_u = jax.random.normal(Y0s_rng, (Nsample, Hsample, Nu))
         # actually this is p(Yi | Y0)
-        Y0s = eps_u * sigmas[i] + Ybar_i
+        Y0s = eps_u * sigma + Ybar_i
         Y0s = jnp.clip(Y0s, -1.0, 1.0)
+        if sample_sharding is not None:
+            Y0s = jax.lax.with_sharding_constraint(Y0s, sample_sharding)
 
         # esitimate mu_0tm1
-        # qs are rollouted states
-        rewss, qs = jax.vmap(rollout_us, in_axes=(None, 0))(state_init, Y0s)
+        # qs are rollouted states, only kept around when evaluating the demo
+        if args.enable_demo:
+            rewss, qs = rollout_us_batch(state_init, Y0s)
+        else:
+            rewss = eval_us_batch(state_init, Y0s)
         rews = rewss.mean(axis=-1)
         rew_std = rews.std()
         rew_std = jnp.where(rew_std < 1e-4, 1.0, rew_std)
@@ -127,48 +175,58 @@ def run_diffusion(args: Args):
             logp0 = jnp.where(demo_mask, logpdemo, logp0)
             logp0 = (logp0 - logp0.mean()) / logp0.std() / args.temp_sample
 
-        weights = jax.nn.softmax(logp0)
-        Ybar = jnp.einsum("n,nij->ij", weights, Y0s)  # NOTE: update only with reward
+        # normalize in log space so the weighting fuses with the weighted mean
+        weights = jnp.exp(logp0 - jax.scipy.special.logsumexp(logp0))
+        # NOTE: update only with reward
+        Ybar = (weights @ Y0s.reshape(Nsample, -1)).reshape(Hsample, Nu)
+
+        score = inv_one_minus_alpha_bar * (-Yi + sqrt_alpha_bar * Ybar)
+        Yim1 = 1 / sqrt_alpha * (Yi + one_minus_alpha_bar * score)
 
-        score = 1 / (1.0 - alphas_bar[i]) * (-Yi + jnp.sqrt(alphas_bar[i]) * Ybar)
-        Yim1 = 1 / jnp.sqrt(alphas[i]) * (Yi + (1.0 - alphas_bar[i]) * score)
+        Ybar_im1 = Yim1 / sqrt_alpha_bar_prev
 
-        Ybar_im1 = Yim1 / jnp.sqrt(alphas_bar[i - 1])
+        # Update the progress bar's suffix to show the current reward
+        jax.lax.cond(
+            (i - 1) % args.pbar_interval == 0,
+            lambda: jax.debug.callback(update_pbar, i, rew_mean),
+            lambda: None,
+        )
 
-        return (i - 1, rng, Ybar_im1), rews.mean()
+        return (rng, Ybar_im1), Ybar_im1
 
     # run reverse
+    # NOTE: all diffusion steps are fused into one compiled graph via lax.scan
+    @jax.jit
     def reverse(YN, rng):
-        Yi = YN
-        Ybars = []
-        with tqdm(range(args.Ndiffuse - 1, 0, -1), desc="Diffusing") as pbar:
-            for i in pbar:
-                carry_once = (i, rng, Yi)
-                (i, rng, Yi), rew = reverse_once(carry_once, None)
-                Ybars.append(Yi)
-                # Update the progress bar's suffix to show the current reward
-                pbar.set_postfix({"rew": f"{rew:.2e}"})
-        return jnp.array(Ybars)
+        steps = jnp.arange(args.Ndiffuse - 1, 0, -1)
+        xs = (steps, jax.tree_util.tree_map(lambda x: x[steps], schedule))
+        # sizes are bound as Python ints so shapes are static when tracing
+        reverse_once_static = functools.partial(
+            reverse_once, Nsample=args.Nsample, Hsample=args.Hsample, Nu=Nu
+        )
+        _, Ybars = jax.lax.scan(reverse_once_static, (rng, YN), xs)
+        return Ybars
 
     rng_exp, rng = jax.random.split(rng)
     Yi = reverse(YN, rng_exp)
+    Yi.block_until_ready()
+    pbar.close()
 
     if not args.not_render:
         path = f"{mbd.__path__[0]}/../results/{args.env_name}"
         if not os.path.exists(path):
             os.makedirs(path)
-        jnp.save(f"{path}/mu_0ts.npy", Yi)
+        # fetch results to host once, saving and plotting are host only
+        np.save(f"{path}/mu_0ts.npy", np.asarray(jax.device_get(Yi)))
         if args.env_name == "car2d":
             fig, ax = plt.subplots(1, 1, figsize=(3, 3))
             # rollout
-            xs = jnp.array([state_init.pipeline_state])
-            state = state_init
-            for t in range(Yi.shape[1]):
-                state = step_env_jit(state, Yi[-1, t])
-                xs = jnp.concatenate([xs, state.pipeline_state[None]], axis=0)
-            env.render(ax, xs)
+            _, xs = rollout_us(state_init, Yi[-1])
+            xs = jnp.concatenate([state_init.pipeline_state[None], xs], axis=0)
+            env.render(ax, np.asarray(jax.device_get(xs)))
             if args.enable_demo:
-                ax.plot(env.xref[:, 0], env.xref[:, 1], "g--", label="RRT path")
+                xref = np.asarray(jax.device_get(env.xref))
+                ax.plot(xref[:, 0], xref[:, 1], "g--", label="RRT path")
             ax.legend()
             plt.savefig(f"{path}/rollout.png")
         else:
@@ -181,8 +239,7 @@ def run_diffusion(args: Args):
             with open(f"{path}/rollout.html", "w") as f:
                 f.write(webpage)
     
-    rewss_final, _ = rollout_us(state_init, Yi[-1])
-    rew_final = rewss_final.mean()
+    rew_final = eval_us(state_init, Yi[-1]).mean()
 
     return rew_final
 
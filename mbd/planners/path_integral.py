@@ -8,9 +8,6 @@ from tqdm import tqdm
 
 import mbd
 
-# NOTE: this is important for simulating long horizon open loop control
-# config.update("jax_enable_x64", True)
-
 
 ## load config
 @dataclass
@@ -19,6 +16,7 @@ class Args:
     seed: int = 0
     disable_recommended_params: bool = False
     update_method: str = "mppi"  # mppi, cma-es, cem
+    enable_x64: bool = False  # float64, helps long horizon open loop control
     # env
     env_name: str = (
         "ant"  # "humanoidstandup", "ant", "halfcheetah", "hopper", "walker2d"
@@ -28,19 +26,25 @@ class Args:
     Hsample: int = 50  # horizon
     Nrefine: int = 100  # number of repeat steps
     temp_sample: float = 0.1  # temperature for sampling
+    pbar_interval: int = 10  # refine steps between progress bar updates
+
+
+def weighted_mean(weights, Y0s):
+    # flatten to a single GEMV instead of a general einsum contraction
+    return (weights @ Y0s.reshape(Y0s.shape[0], -1)).reshape(Y0s.shape[1:])
 
 
 @jax.jit
 def softmax_update(weights, Y0s, sigma, mu_0t):
-    mu_0tm1 = jnp.einsum("n,nij->ij", weights, Y0s)
+    mu_0tm1 = weighted_mean(weights, Y0s)
     return mu_0tm1, sigma
 
 
 @jax.jit
 def cma_es_update(weights, Y0s, sigma, mu_0t):
-    mu_0tm1 = jnp.einsum("n,nij->ij", weights, Y0s)
+    mu_0tm1 = weighted_mean(weights, Y0s)
     Yerr = Y0s - mu_0t
-    sigma = jnp.sqrt(jnp.einsum("n,nij->ij", weights, Yerr**2)).mean() * sigma
+    sigma = jnp.sqrt(weighted_mean(weights, Yerr**2)).mean() * sigma
     sigma = jnp.maximum(sigma, 1e-3)
     return mu_0tm1, sigma
 
@@ -53,6 +57,14 @@ def cem_update(weights, Y0s, sigma, mu_0t):
 
 
 def run_path_integral(args: Args):
+    with mbd.utils.enable_x64(args.enable_x64):
+        return _run_path_integral(args)
+
+
+def _run_path_integral(args: Args):
+
+    if args.pbar_interval < 1:
+        raise ValueError(f"pbar_interval must be at least 1, got {args.pbar_interval}")
 
     rng = jax.random.PRNGKey(seed=args.seed)
 
@@ -97,6 +109,8 @@ def run_path_integral(args: Args):
     step_env_jit = jax.jit(env.step)
     reset_env_jit = jax.jit(env.reset)
     eval_us = jax.jit(functools.partial(mbd.utils.eval_us, step_env_jit))
+    eval_us_batch = jax.jit(jax.vmap(eval_us, in_axes=(None, 0)))
+    sample_sharding = mbd.utils.get_sample_sharding(args.Nsample)
     
     if hasattr(env.sys, "dt"):
         render_us = functools.partial(
@@ -113,41 +127,53 @@ def run_path_integral(args: Args):
 
     mu_0T = jnp.zeros([args.Hsample, Nu])
 
-    @jax.jit
-    def update_once(carry, unused):
-        t, rng, mu_0t, sigma = carry
+    pbar = tqdm(total=args.Nrefine - 1, desc="Path Integrating")
+
+    def update_pbar(t, rew):
+        pbar.set_postfix({"rew": f"{rew:.2e}"})
+        pbar.update(max(args.Nrefine - int(t) - pbar.n, 0))
+
+    def update_once(carry, t):
+        rng, mu_0t, sigma = carry
 
         # sample from q_i
-        rng, Y0s_rng = jax.random.split(rng)
+        # NOTE: derive the noise key from the step instead of splitting in the carry
+        Y0s_rng = jax.random.fold_in(rng, t)
         eps_u = jax.random.normal(Y0s_rng, (args.Nsample, args.Hsample, Nu)) * sigma
         Y0s = eps_u + mu_0t
         Y0s = jnp.clip(Y0s, -1.0, 1.0)
+        if sample_sharding is not None:
+            Y0s = jax.lax.with_sharding_constraint(Y0s, sample_sharding)
 
         # esitimate mu_0tm1
-        rews = jax.vmap(eval_us, in_axes=(None, 0))(state_init, Y0s).mean(axis=-1)
+        rews = eval_us_batch(state_init, Y0s).mean(axis=-1)
         logp0 = (rews - rews.mean()) / rews.std() / args.temp_sample
-        weights = jax.nn.softmax(logp0)
+        # normalize in log space so the weighting fuses with the weighted mean
+        weights = jnp.exp(logp0 - jax.scipy.special.logsumexp(logp0))
         mu_0tm1, sigma = update_fn(weights, Y0s, sigma, mu_0t)
 
-        return (t - 1, rng, mu_0tm1, sigma), rews.mean()
+        # Update the progress bar's suffix to show the current reward
+        jax.lax.cond(
+            (t - 1) % args.pbar_interval == 0,
+            lambda: jax.debug.callback(update_pbar, t, rews.mean()),
+            lambda: None,
+        )
+
+        return (rng, mu_0tm1, sigma), mu_0tm1
 
     # run reverse
+    @jax.jit
     def update(mu_0T, rng):
-        sigma = 1.0
-        mu_0t = mu_0T
-        mu_0ts = []
-        with tqdm(range(args.Nrefine - 1, 0, -1), desc="Path Integrating") as pbar:
-            for t in pbar:
-                carry_once = (t, rng, mu_0t, sigma)
-                (t, rng, mu_0t, sigma), rew = update_once(carry_once, None)
-                mu_0ts.append(mu_0t)
-                # Update the progress bar's suffix to show the current reward
-                pbar.set_postfix({"rew": f"{rew:.2e}"})
+        sigma = jnp.ones(())
+        _, mu_0ts = jax.lax.scan(
+            update_once, (rng, mu_0T, sigma), jnp.arange(args.Nrefine - 1, 0, -1)
+        )
         return mu_0ts
 
     rng_exp, rng = jax.random.split(rng)
     mu_0ts = update(mu_0T, rng_exp)
-    mu_0ts = jnp.array(mu_0ts)
+    mu_0ts.block_until_ready()
+    pbar.close()
     rew_final = eval_us(state_init, mu_0ts[-1]).mean()
 
     return rew_final
@@ -1,3 +1,4 @@
+import functools
 import jax
 from jax import numpy as jnp
 from brax.io import html
@@ -16,6 +17,7 @@ jax.config.update("jax_platform_name", "cpu")
 env_name = "humanoidtrack"
 env = mbd.envs.get_env(env_name)
 step_env_jit = jax.jit(env.step)
+rollout_us = jax.jit(functools.partial(mbd.utils.rollout_us, step_env_jit))
 Hsample = 50
 plot_interval = 10
 path = f"{mbd.__path__[0]}/../results/{env_name}"
@@ -113,12 +115,16 @@ def dumps(sys, statess) -> str:
 
 
 def render_us(state, us):
-    rollout = []
-    rew_sum = 0.0
-    for i in range(Hsample):
-        rollout.append(state.pipeline_state)
-        state = step_env_jit(state, us[i])
-        rew_sum += state.reward
+    # states before each step: the initial state followed by all but the last
+    _, pipeline_states = rollout_us(state, us)
+    pipeline_states = tree_map(
+        lambda x0, xs: jnp.concatenate([x0[None], xs[:-1]]),
+        state.pipeline_state,
+        pipeline_states,
+    )
+    # fetch to host once, then unstack without per-slice device dispatches
+    pipeline_states = jax.device_get(pipeline_states)
+    rollout = [tree_map(lambda x: x[i], pipeline_states) for i in range(Hsample)]
     return rollout
 
 
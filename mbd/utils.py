@@ -1,8 +1,21 @@
+import contextlib
 import jax
 from brax.io import html
 
 
+# scope jax_enable_x64 to a single run instead of the whole process
+@contextlib.contextmanager
+def enable_x64(enable):
+    enable_prev = jax.config.jax_enable_x64
+    jax.config.update("jax_enable_x64", enable)
+    try:
+        yield
+    finally:
+        jax.config.update("jax_enable_x64", enable_prev)
+
+
 # evaluate the diffused uss
+# NOTE: step_env is traced into the scan, so the input state is not donated
 def eval_us(step_env, state, us):
     def step(state, u):
         state = step_env(state, u)
@@ -20,15 +33,24 @@ def rollout_us(step_env, state, us):
     return rews, pipline_states
 
 
+# shard the sample axis across local devices, rollouts are independent per sample
+def get_sample_sharding(Nsample):
+    n_dev = jax.local_device_count()
+    if n_dev == 1 or Nsample % n_dev != 0:
+        return None
+    mesh = jax.sharding.Mesh(jax.local_devices(), ("sample",))
+    return jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec("sample"))
+
+
 def render_us(step_env, sys, state, us):
-    rollout = []
-    rew_sum = 0.0
+    def step(state, u):
+        return step_env(state, u), state.pipeline_state
+
+    # roll out on device in one scan, then unstack on host for the visualizer
+    _, pipeline_states = jax.lax.scan(step, state, us)
+    pipeline_states = jax.device_get(pipeline_states)
     Hsample = us.shape[0]
-    for i in range(Hsample):
-        rollout.append(state.pipeline_state)
-        state = step_env(state, us[i])
-        rew_sum += state.reward
-    # rew_mean = rew_sum / (Hsample)
-    # print(f"evaluated reward mean: {rew_mean:.2e}")
+    rollout = [
+        jax.tree_util.tree_map(lambda x: x[i], pipeline_states) for i in range(Hsample)
+    ]
     return html.render(sys, rollout)
-